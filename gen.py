@@ -19,8 +19,8 @@ def main():
         script_name = "gen_image.py"
 
     try:
-        # 调用相应的脚本
-        result = subprocess.run([sys.executable, script_name], check=True)
+        # 调用相应的脚本 (透传命令行参数，如 --max-concurrency)
+        result = subprocess.run([sys.executable, script_name] + sys.argv[1:], check=True)
         print(f"Successfully executed {script_name}")
     except subprocess.CalledProcessError as e:
         print(f"Error executing {script_name}: {e}")
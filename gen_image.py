@@ -1,11 +1,14 @@
+import argparse
+import io
 import json
-import math
 import shutil
+import threading
 import urllib.parse
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from itertools import cycle
+from itertools import cycle, islice
 
 try:
     from PIL import Image
@@ -14,6 +17,9 @@ except ImportError:
     HAS_PILLOW = False
     print("Warning: Pillow is not installed. Aspect ratio classification will be skipped.")
 
+# Pillow-SIMD 的版本号带 .postN 后缀；它在 C 层释放 GIL 更彻底，线程池即可跑满
+HAS_PILLOW_SIMD = HAS_PILLOW and '.post' in getattr(Image, '__version__', '')
+
 # ================= 配置区域 =================
 
 # 基础 Hex 长度 (保底)
@@ -28,6 +34,9 @@ OUTPUT_DIR = Path("dist")
 # 是否转换 WebP (True/False)
 CONVERT_WEBP = True
 
+# WebP 编码速度/压缩率权衡 (0=最快, 6=体积最小, Pillow 默认 4)
+WEBP_METHOD = 4
+
 # 输出文件后缀
 DEFAULT_EXT = ".jpg" 
 
@@ -46,7 +55,9 @@ def calculate_hex_len(item_count: int, min_len: int) -> int:
     """根据数据量自动计算所需的 Hex 长度"""
     if item_count == 0:
         return min_len
-    needed = math.ceil(math.log(item_count, 16))
+    # 纯整数运算：表示 item_count-1 需要的 nibble 数。
+    # math.log 的浮点误差在 16 的幂附近可能多算一位 (多出 16 倍槽位)
+    needed = max(1, (item_count - 1).bit_length() + 3) // 4
     return max(min_len, needed)
 
 def generate_cf_rule(hex_len: int) -> str:
@@ -101,94 +112,228 @@ def generate_cf_rule(hex_len: int) -> str:
     return "\n".join(content)
 
 def ensure_dir(path: Path):
+    """清空并重建目录：先整体改名，再在后台线程删除，不阻塞后续写入"""
     if path.exists():
-        shutil.rmtree(path)
+        old_path = path.with_name(path.name + ".old")
+        # 上次运行可能异常退出留下残骸，先清掉才能改名
+        if old_path.exists():
+            shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+        threading.Thread(
+            target=shutil.rmtree, args=(old_path,), kwargs={'ignore_errors': True}
+        ).start()
     path.mkdir(parents=True)
 
+def iter_image_files(root: Path, exts):
+    """基于 os.scandir 递归遍历图片文件。
+
+    直接利用 dirent 缓存的类型信息判断文件/目录，比 Path.rglob
+    逐项包装 Path 并 stat 快得多；只有匹配的条目才包装成 Path。
+    """
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        _, dot, suffix = entry.name.rpartition('.')
+                        if dot and suffix.lower() in exts:
+                            yield Path(entry.path)
+        except OSError as e:
+            print(f"Warning: Could not scan {current}: {e}")
+
+def classify_image(file_path: Path):
+    """打开单个图片读取尺寸和色彩模式 (供线程池调用)，失败时返回 None"""
+    item = {'path': file_path}
+    try:
+        # 只打开一次，顺便缓存尺寸和色彩模式，后续处理不再重复读头
+        with Image.open(file_path) as img:
+            item['mode'] = img.mode
+            item['size'] = img.size
+    except Exception as e:
+        print(f"Warning: Could not open {file_path}: {e}")
+        return None
+    return item
+
 def scan_images(source_dir: Path):
     """扫描所有图片并分类"""
     all_imgs = []
     landscape_imgs = []
     portrait_imgs = []
-    
+
     if not source_dir.exists():
         print(f"Error: Source directory '{source_dir}' does not exist.")
         return [], [], []
 
-    exts = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff'}
-    
+    exts = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
+
     print(f"Scanning images in {source_dir}...")
-    
-    for file_path in source_dir.rglob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in exts:
-            
+
+    file_paths = list(iter_image_files(source_dir, exts))
+
+    if not HAS_PILLOW:
+        for file_path in file_paths:
             item = {'path': file_path}
-            
-            is_portrait = False
-            try:
-                if HAS_PILLOW:
-                    with Image.open(file_path) as img:
-                        width, height = img.size
-                        if width > height:
-                            landscape_imgs.append(item)
-                        else:
-                            portrait_imgs.append(item)
-                            is_portrait = True
-                else:
-                    landscape_imgs.append(item)
-            except Exception as e:
-                print(f"Warning: Could not open {file_path}: {e}")
+            landscape_imgs.append(item)
+            all_imgs.append(item)
+        return all_imgs, landscape_imgs, portrait_imgs
+
+    # 读图片头属于 I/O 密集型操作，线程数适当超配
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in executor.map(classify_image, file_paths):
+            if item is None:
                 continue
-            
+            width, height = item['size']
+            if width > height:
+                landscape_imgs.append(item)
+            else:
+                portrait_imgs.append(item)
             all_imgs.append(item)
 
     return all_imgs, landscape_imgs, portrait_imgs
 
+def fast_copy(source_path: Path, target_path: Path):
+    """复制文件：优先内核态零拷贝 (copy_file_range/sendfile)，退回用户态缓冲复制"""
+    size = source_path.stat().st_size
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        copied = False
+
+        # copy_file_range: Linux 4.5+，在 btrfs/XFS/NFS 上可触发 reflink/服务端拷贝
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = size
+                while remaining > 0:
+                    sent = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if sent == 0:
+                        break
+                    remaining -= sent
+                copied = (remaining == 0)
+            except OSError:
+                pass
+
+        # sendfile: 仍然是内核态拷贝，避免用户态缓冲
+        if not copied and hasattr(os, 'sendfile'):
+            try:
+                dst.seek(0)
+                dst.truncate()
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                copied = (offset >= size)
+            except OSError:
+                pass
+
+        if not copied:
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+    shutil.copystat(source_path, target_path)
+
 def process_file(source_path: Path, target_path: Path):
     """处理文件：转换或复制"""
     if CONVERT_WEBP:
         try:
             with Image.open(source_path) as img:
                 if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                     pass 
+                     pass
                 else:
                      img = img.convert('RGB')
-                img.save(target_path, 'WEBP', quality=85)
+                # 先编码到内存再一次性落盘，跳过 Pillow 文件句柄的逐段写开销
+                buf = io.BytesIO()
+                img.save(buf, 'WEBP', quality=85, method=WEBP_METHOD)
+            target_path.write_bytes(buf.getvalue())
         except Exception as e:
             print(f"Error converting {source_path}: {e}")
     else:
-        shutil.copy2(source_path, target_path)
+        fast_copy(source_path, target_path)
+
+def link_or_copy(source_path: Path, target_path: Path):
+    """优先硬链接，失败时 (跨设备/Windows) 退回复制"""
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        fast_copy(source_path, target_path)
 
-def write_files_prefix(data_list, output_dir: Path, hex_len: int, subdir_name: str):
+def make_executor(max_workers: int = None):
+    """为编码阶段挑选进程池或线程池。
+
+    普通 Pillow 的 WebP 编码只部分释放 GIL，CPU 密集的转换用进程池
+    才能真正吃满多核；Pillow-SIMD 或纯复制场景用线程池省掉进程开销。
+    """
+    if CONVERT_WEBP and not HAS_PILLOW_SIMD:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+def write_files_prefix(data_list, output_dir: Path, hex_len: int, subdir_name: str, max_workers: int = None):
     """使用子目录模式写入文件"""
     if not data_list:
         return
 
+    # main() 已统一清理并创建输出目录
     target_dir = output_dir / subdir_name
-    ensure_dir(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
 
     total_slots = 16 ** hex_len
-    buckets = [[] for _ in range(total_slots)]
-    
-    data_cycle = cycle(data_list)
-    for i in range(total_slots):
-        buckets[i] = next(data_cycle)
-    
+
     ext = ".webp" if CONVERT_WEBP else DEFAULT_EXT
 
-    for i in range(total_slots):
-        hex_name = f"{i:0{hex_len}x}"
-        target_filename = f"{hex_name}{ext}"
-        target_path = target_dir / target_filename
-        
-        source_item = buckets[i]
-        source_path = source_item['path']
-        
-        process_file(source_path, target_path)
+    # 预生成所有目标文件名，热循环里不再反复解析动态宽度的格式串
+    target_names = ['%0*x%s' % (hex_len, i, ext) for i in range(total_slots)]
+
+    # 每个源图片只编码一次，重复槽位直接硬链接/复制，
+    # 把 Pillow 工作量从 16**hex_len 降到 len(data_list)
+    encoded = {}
+    duplicate_slots = []
+
+    with make_executor(max_workers) as executor:
+        futures = []
+        # 直接迭代循环流，不额外物化 16**hex_len 大小的中间列表
+        for i, source_item in enumerate(islice(cycle(data_list), total_slots)):
+            target_path = target_dir / target_names[i]
+            source_path = source_item['path']
+
+            if source_path in encoded:
+                duplicate_slots.append((source_path, target_path))
+            else:
+                encoded[source_path] = target_path
+                futures.append(executor.submit(process_file, source_path, target_path))
+
+        for future in futures:
+            future.result()
+
+    for source_path, target_path in duplicate_slots:
+        primary_path = encoded[source_path]
+        # process_file 转码失败时只打日志不产出文件，对应槽位跳过
+        if not primary_path.exists():
+            print(f"Warning: Skipping slot {target_path.name}: {source_path} was not encoded")
+            continue
+        link_or_copy(primary_path, target_path)
 
     print(f"  Generated {total_slots} files in '{subdir_name}/'")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate random image copies for Cloudflare rules.")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=os.cpu_count(),
+        help="Max worker threads for image processing (default: CPU count)",
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # 1. 扫描
     all_imgs, landscape, portrait = scan_images(SOURCE_DIR)
     
@@ -204,34 +349,35 @@ def main():
     hex_len = calculate_hex_len(len(all_imgs), MIN_HEX_LEN)
     print(f"Calculated Hex Length: {hex_len}")
     
-    # 3. 清理并生成目录
+    # 3. 清理一次输出根目录，再一趟建好所有非空分类的子目录
     ensure_dir(OUTPUT_DIR)
-    
+    for subdir_name, data_list in (("l", landscape), ("p", portrait), ("all", all_imgs)):
+        if data_list:
+            (OUTPUT_DIR / subdir_name).mkdir(parents=True, exist_ok=True)
+
     # 4. 生成文件
     print("Starting Image Mode Generation (Shadow Copy)...")
     print("Generating landscape files (/l/)...")
-    write_files_prefix(landscape, OUTPUT_DIR, hex_len, "l")
-    
+    write_files_prefix(landscape, OUTPUT_DIR, hex_len, "l", args.max_concurrency)
+
     print("Generating portrait files (/p/)...")
-    write_files_prefix(portrait, OUTPUT_DIR, hex_len, "p")
-    
+    write_files_prefix(portrait, OUTPUT_DIR, hex_len, "p", args.max_concurrency)
+
     print("Generating all files (/all/)...")
-    write_files_prefix(all_imgs, OUTPUT_DIR, hex_len, "all")
+    write_files_prefix(all_imgs, OUTPUT_DIR, hex_len, "all", args.max_concurrency)
     
     # 5. 生成 rules.txt
-    rules = generate_cf_rule(hex_len)
-    with open("rules.txt", 'w', encoding='utf-8') as f:
-        f.write(rules)
-    
+    Path("rules.txt").write_text(generate_cf_rule(hex_len), encoding='utf-8')
+
     # 6. 生成 CNAME 文件
     if DOMAIN:
-        with open("CNAME", 'w', encoding='utf-8') as f:
-            f.write(DOMAIN)
+        Path("CNAME").write_text(DOMAIN, encoding='utf-8')
         print(f"Generated CNAME file: {DOMAIN}")
-    
+
     # 7. 生成 index.html
-    with open("index.html", 'w', encoding='utf-8') as f:
-        f.write("<h1>Cloudflare Random Image API</h1><p>Visit <a href='/rules.txt'>/rules.txt</a> for configuration.</p>")
+    Path("index.html").write_text(
+        "<h1>Cloudflare Random Image API</h1><p>Visit <a href='/rules.txt'>/rules.txt</a> for configuration.</p>",
+        encoding='utf-8')
     print("Generated index.html")
         
     print("Done! Check 'dist' directory and 'rules.txt'.")
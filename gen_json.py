@@ -1,11 +1,15 @@
+import argparse
+import hashlib
+import io
 import json
-import math
 import shutil
+import threading
 import urllib.parse
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from itertools import cycle
+from itertools import cycle, islice
 
 try:
     from PIL import Image
@@ -28,8 +32,16 @@ OUTPUT_DIR = Path("dist")
 # 是否转换 WebP (True/False)
 CONVERT_WEBP = True
 
+# WebP 编码速度/压缩率权衡 (0=最快, 6=体积最小, Pillow 默认 4)
+WEBP_METHOD = 4
+
 # 输出文件后缀
-DEFAULT_EXT = ".jpg" 
+DEFAULT_EXT = ".jpg"
+
+# 增量清单 (记录 源文件 -> mtime/输出名/尺寸)。
+# 特意放在 dist 之外：dist 会被 CI 整体提交并部署，清单混进去
+# 每次运行都会制造一个无意义的 diff
+MANIFEST_PATH = Path(".image_manifest.json")
 
 # 部署域名
 DOMAIN = "image.blueke.dpdns.org"
@@ -49,7 +61,9 @@ def calculate_hex_len(item_count: int, min_len: int) -> int:
     """根据数据量自动计算所需的 Hex 长度"""
     if item_count == 0:
         return min_len
-    needed = math.ceil(math.log(item_count, 16))
+    # 纯整数运算：表示 item_count-1 需要的 nibble 数。
+    # math.log 的浮点误差在 16 的幂附近可能多算一位 (多出 16 倍槽位)
+    needed = max(1, (item_count - 1).bit_length() + 3) // 4
     return max(min_len, needed)
 
 def get_base_url() -> str:
@@ -113,141 +127,291 @@ def generate_cf_rule(hex_len: int) -> str:
     return "\n".join(content)
 
 def ensure_dir(path: Path):
+    """清空并重建目录：先整体改名，再在后台线程删除，不阻塞后续写入"""
     if path.exists():
-        shutil.rmtree(path)
+        old_path = path.with_name(path.name + ".old")
+        # 上次运行可能异常退出留下残骸，先清掉才能改名
+        if old_path.exists():
+            shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+        threading.Thread(
+            target=shutil.rmtree, args=(old_path,), kwargs={'ignore_errors': True}
+        ).start()
     path.mkdir(parents=True)
 
-def scan_images(source_dir: Path):
-    """扫描所有图片并分类"""
-    all_imgs = []
-    landscape_imgs = []
-    portrait_imgs = []
-    
-    if not source_dir.exists():
-        print(f"Error: Source directory '{source_dir}' does not exist.")
-        return [], [], []
+def iter_image_files(root: Path, exts):
+    """基于 os.scandir 递归遍历图片文件。
 
-    exts = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff'}
-    
-    print(f"Scanning images in {source_dir}...")
-    
-    for file_path in source_dir.rglob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in exts:
-            
-            item = {'path': file_path}
-            
-            is_portrait = False
+    直接利用 dirent 缓存的类型信息判断文件/目录，比 Path.rglob
+    逐项包装 Path 并 stat 快得多；只有匹配的条目才包装成 Path。
+    """
+    stack = [str(root)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        _, dot, suffix = entry.name.rpartition('.')
+                        if dot and suffix.lower() in exts:
+                            yield Path(entry.path)
+        except OSError as e:
+            print(f"Warning: Could not scan {current}: {e}")
+
+def fast_copy(source_path: Path, target_path: Path):
+    """复制文件：优先内核态零拷贝 (copy_file_range/sendfile)，退回用户态缓冲复制"""
+    size = source_path.stat().st_size
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        src_fd, dst_fd = src.fileno(), dst.fileno()
+        copied = False
+
+        # copy_file_range: Linux 4.5+，在 btrfs/XFS/NFS 上可触发 reflink/服务端拷贝
+        if hasattr(os, 'copy_file_range'):
             try:
-                if HAS_PILLOW:
-                    with Image.open(file_path) as img:
-                        width, height = img.size
-                        if width > height:
-                            landscape_imgs.append(item)
-                        else:
-                            portrait_imgs.append(item)
-                            is_portrait = True
-                else:
-                    landscape_imgs.append(item)
-            except Exception as e:
-                print(f"Warning: Could not open {file_path}: {e}")
-                continue
-            
-            all_imgs.append(item)
+                remaining = size
+                while remaining > 0:
+                    sent = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if sent == 0:
+                        break
+                    remaining -= sent
+                copied = (remaining == 0)
+            except OSError:
+                pass
 
-    return all_imgs, landscape_imgs, portrait_imgs
+        # sendfile: 仍然是内核态拷贝，避免用户态缓冲
+        if not copied and hasattr(os, 'sendfile'):
+            try:
+                dst.seek(0)
+                dst.truncate()
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                copied = (offset >= size)
+            except OSError:
+                pass
 
-def process_file(source_path: Path, target_path: Path):
-    """处理文件：转换或复制"""
-    if CONVERT_WEBP:
-        try:
-            with Image.open(source_path) as img:
+        if not copied:
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+    shutil.copystat(source_path, target_path)
+
+def process_and_classify(source_path: Path, target_dir: Path, ext: str,
+                         seen_hashes: set, seen_lock: threading.Lock,
+                         manifest: dict):
+    """融合管线：一次读取完成去重 + 分类 + 转换 + 写盘 (供线程池调用)。
+
+    输出文件名取源文件内容的 blake2b 摘要：相同内容的图片只编码一次，
+    且多次运行产出稳定的文件名 (内容寻址，幂等)。
+    源文件 mtime 与清单一致且输出仍在时，直接复用上次结果，整张图
+    连读都不用读 (增量重建)。失败时返回 None。
+    """
+    try:
+        source_mtime = source_path.stat().st_mtime
+    except OSError as e:
+        print(f"Error processing {source_path}: {e}")
+        return None
+
+    cached = manifest.get(str(source_path))
+    if cached and cached.get('mtime') == source_mtime:
+        target_filename = cached['target_filename']
+        if (target_dir / target_filename).exists():
+            with seen_lock:
+                seen_hashes.add(target_filename.rsplit('.', 1)[0])
+            item = {'path': source_path, 'target_filename': target_filename,
+                    'mtime': source_mtime}
+            if 'size' in cached:
+                item['size'] = tuple(cached['size'])
+            return item
+
+    try:
+        source_bytes = source_path.read_bytes()
+    except OSError as e:
+        print(f"Error processing {source_path}: {e}")
+        return None
+
+    digest = hashlib.blake2b(source_bytes, digest_size=8).hexdigest()
+    target_filename = f"{digest}{ext}"
+    target_path = target_dir / target_filename
+    item = {'path': source_path, 'target_filename': target_filename,
+            'mtime': source_mtime}
+
+    with seen_lock:
+        is_duplicate = digest in seen_hashes
+        seen_hashes.add(digest)
+
+    if not HAS_PILLOW:
+        if not is_duplicate:
+            fast_copy(source_path, target_path)
+        return item
+
+    try:
+        with Image.open(io.BytesIO(source_bytes)) as img:
+            item['size'] = img.size
+            item['mode'] = img.mode
+            if is_duplicate:
+                # 相同内容已由其他任务处理，读完尺寸即可
+                return item
+            if CONVERT_WEBP:
                 if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
-                     pass 
+                     pass
                 else:
                      img = img.convert('RGB')
-                img.save(target_path, 'WEBP', quality=85)
-        except Exception as e:
-            print(f"Error converting {source_path}: {e}")
-    else:
-        shutil.copy2(source_path, target_path)
+                # 先编码到内存再一次性落盘，跳过 Pillow 文件句柄的逐段写开销
+                buf = io.BytesIO()
+                img.save(buf, 'WEBP', quality=85, method=WEBP_METHOD)
+        if CONVERT_WEBP:
+            target_path.write_bytes(buf.getvalue())
+        else:
+            fast_copy(source_path, target_path)
+    except Exception as e:
+        print(f"Error processing {source_path}: {e}")
+        return None
+
+    return item
 
 def write_json_files(data_list, output_dir: Path, hex_len: int, subdir_name: str, images_dir_name: str = "images"):
     """
     生成 JSON 文件，内容指向真实图片 URL。
     """
+    target_dir = output_dir / subdir_name
+
     if not data_list:
+        # 分类为空时也要清掉上次运行残留的槽位目录：
+        # 旧 JSON 会指向已被清单清理掉的图片 (悬空链接)
+        if target_dir.exists():
+            shutil.rmtree(target_dir)
         return
 
-    target_dir = output_dir / subdir_name
     ensure_dir(target_dir)
 
     total_slots = 16 ** hex_len
-    buckets = [[] for _ in range(total_slots)]
-    
-    data_cycle = cycle(data_list)
-    for i in range(total_slots):
-        buckets[i] = next(data_cycle)
-    
-    base_url = get_base_url()
 
-    for i in range(total_slots):
-        hex_name = f"{i:0{hex_len}x}"
-        
-        source_item = buckets[i]
+    # URL 前缀是常量，在循环外拼好，槽位里只剩一次字符串连接
+    url_prefix = f"{get_base_url()}/{images_dir_name}/"
+
+    # JSON 结构固定，预生成模板直接拼字符串，省掉每个文件一次 json.dump 编码
+    template = '{{"url": "{}"}}'
+
+    # 预生成所有目标文件名，热循环里不再反复解析动态宽度的格式串
+    json_names = ['%0*x.json' % (hex_len, i) for i in range(total_slots)]
+
+    # 直接迭代循环流，不额外物化 16**hex_len 大小的中间列表
+    for i, source_item in enumerate(islice(cycle(data_list), total_slots)):
         real_image_filename = source_item.get('target_filename')
         if not real_image_filename:
              print(f"Error: Missing target filename for {source_item['path']}")
              continue
-             
-        target_url = f"{base_url}/{images_dir_name}/{real_image_filename}"
-        
-        json_content = {
-            "url": target_url
-        }
-        
-        json_filename = f"{hex_name}.json"
-        json_path = target_dir / json_filename
-        
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(json_content, f)
+
+        target_url = url_prefix + real_image_filename
+
+        json_path = target_dir / json_names[i]
+
+        json_path.write_bytes(template.format(target_url).encode('utf-8'))
 
     print(f"  Generated {total_slots} json files in '{subdir_name}/'")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate random image JSON index for Cloudflare rules.")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=os.cpu_count(),
+        help="Max worker threads for image processing (default: CPU count)",
+    )
+    return parser.parse_args()
+
 def main():
-    # 1. 扫描
-    all_imgs, landscape, portrait = scan_images(SOURCE_DIR)
-    
+    args = parse_args()
+
+    # 1. 扫描文件列表
+    if not SOURCE_DIR.exists():
+        print(f"Error: Source directory '{SOURCE_DIR}' does not exist.")
+        sys.exit(1)
+
+    exts = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tiff'}
+
+    print(f"Scanning images in {SOURCE_DIR}...")
+    file_paths = list(iter_image_files(SOURCE_DIR, exts))
+
+    # 2. 准备目录：一次 mkdir 连根目录一起建出来
+    # (images/ 跨运行保留做增量重建，l/p/all 由 write_json_files 按需重建)
+    images_dir = OUTPUT_DIR / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = MANIFEST_PATH
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            manifest = {}
+
+    ext = ".webp" if CONVERT_WEBP else DEFAULT_EXT
+
+    # 3. 融合管线：单遍完成 分类 + 转换 + 写盘，每张图只打开一次
+    print("Starting JSON Mode Generation...")
+    print("Processing source images to /images/...")
+
+    all_imgs = []
+    landscape = []
+    portrait = []
+
+    seen_hashes = set()
+    seen_lock = threading.Lock()
+
+    # Pillow 的解码/编码在 C 层释放 GIL，多线程可以跑满多核
+    with ThreadPoolExecutor(max_workers=args.max_concurrency) as executor:
+        futures = [
+            executor.submit(process_and_classify, file_path, images_dir, ext,
+                            seen_hashes, seen_lock, manifest)
+            for file_path in file_paths
+        ]
+        for future in futures:
+            item = future.result()
+            if item is None:
+                continue
+            # 无 Pillow 时不知道尺寸，沿用旧行为按横屏处理
+            width, height = item.get('size', (1, 0))
+            if width > height:
+                landscape.append(item)
+            else:
+                portrait.append(item)
+            all_imgs.append(item)
+
     print(f"Found {len(all_imgs)} images.")
     print(f"  Landscape: {len(landscape)}")
     print(f"  Portrait:  {len(portrait)}")
-    
+
     if len(all_imgs) == 0:
         print("Error: No images found.")
         sys.exit(1)
 
-    # 2. 计算 Hex 长度
+    # 更新清单，并清理不再被引用的旧输出
+    new_manifest = {}
+    for item in all_imgs:
+        entry = {'mtime': item['mtime'], 'target_filename': item['target_filename']}
+        if 'size' in item:
+            entry['size'] = list(item['size'])
+        new_manifest[str(item['path'])] = entry
+
+    referenced = {entry['target_filename'] for entry in new_manifest.values()}
+    for child in images_dir.iterdir():
+        if child.name not in referenced:
+            child.unlink()
+    manifest_path.write_text(json.dumps(new_manifest), encoding='utf-8')
+
+    # 4. 计算 Hex 长度并生成 JSON
     hex_len = calculate_hex_len(len(all_imgs), MIN_HEX_LEN)
     print(f"Calculated Hex Length: {hex_len}")
-    
-    # 3. 清理并生成目录
-    ensure_dir(OUTPUT_DIR)
-    
-    # 4. 生成文件
-    print("Starting JSON Mode Generation...")
-    
-    images_dir = OUTPUT_DIR / "images"
-    ensure_dir(images_dir)
-    
-    ext = ".webp" if CONVERT_WEBP else DEFAULT_EXT
-    
-    print("Processing source images to /images/...")
-    for idx, item in enumerate(all_imgs):
-        target_filename = f"{idx}{ext}"
-        target_path = images_dir / target_filename
-        
-        process_file(item['path'], target_path)
-        item['target_filename'] = target_filename
-        
+
     print("Generating JSON files for /l/...")
     write_json_files(landscape, OUTPUT_DIR, hex_len, "l")
     
@@ -258,19 +422,17 @@ def main():
     write_json_files(all_imgs, OUTPUT_DIR, hex_len, "all")
     
     # 5. 生成 rules.txt
-    rules = generate_cf_rule(hex_len)
-    with open("rules.txt", 'w', encoding='utf-8') as f:
-        f.write(rules)
-    
+    Path("rules.txt").write_text(generate_cf_rule(hex_len), encoding='utf-8')
+
     # 6. 生成 CNAME 文件
     if DOMAIN:
-        with open("CNAME", 'w', encoding='utf-8') as f:
-            f.write(DOMAIN)
+        Path("CNAME").write_text(DOMAIN, encoding='utf-8')
         print(f"Generated CNAME file: {DOMAIN}")
-    
+
     # 7. 生成 index.html
-    with open("index.html", 'w', encoding='utf-8') as f:
-        f.write("<h1>Cloudflare Random Image API</h1><p>Visit <a href='/rules.txt'>/rules.txt</a> for configuration.</p>")
+    Path("index.html").write_text(
+        "<h1>Cloudflare Random Image API</h1><p>Visit <a href='/rules.txt'>/rules.txt</a> for configuration.</p>",
+        encoding='utf-8')
     print("Generated index.html")
         
     print("Done! Check 'dist' directory and 'rules.txt'.")